@@ -1,9 +1,24 @@
-import json, os, sys, asyncio, signal
-from datetime import datetime
+import json, os, sys, asyncio, signal, functools, itertools, ssl, socket
+import atexit, logging, logging.handlers, queue, random, time
 import paho.mqtt.client as mqtt
-import re
+import fnmatch, re
+from collections import OrderedDict
+import urllib.error, urllib.request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 OPTIONS_FILE = "/data/options.json"
+CA_FILE = "/data/ca.pem"
+CA_ETAG_FILE = "/data/ca.etag"
+CA_REFRESH_SECONDS = 86400
 HA_WS_URL = "ws://supervisor/core/api/websocket"
 shutdown_event = asyncio.Event()
 
@@ -11,14 +26,66 @@ shutdown_event = asyncio.Event()
 # Logging
 # ---------------------------------------------------------------------
 
+# log() only enqueues; formatting and stdout writes run on the listener
+# thread. LOG_LEVEL=DEBUG adds per-publish lines.
+_ts_cache = [0, ""]   # [epoch second, formatted UTC timestamp]
+
+def _now_iso(ts):
+    sec = int(ts)
+    if sec != _ts_cache[0]:
+        _ts_cache[:] = [sec, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))]
+    return _ts_cache[1]
+
+class _Formatter(logging.Formatter):
+    def format(self, record):
+        return f"[{_now_iso(record.created)}] [{record.tag}] {record.getMessage()}"
+
+@functools.lru_cache(maxsize=None)
+def _level(tag):
+    if tag == "FATAL": return logging.CRITICAL
+    if tag.endswith("_ERROR"): return logging.ERROR
+    if tag.endswith("_WARN"): return logging.WARNING
+    if tag == "MQTT_SENT": return logging.DEBUG
+    return logging.INFO
+
+_LOG_Q = queue.SimpleQueue()
+_logger = logging.getLogger("openiotai")
+_logger.propagate = False
+_lvl = getattr(logging, os.environ.get("LOG_LEVEL", "INFO").upper(), logging.INFO)
+_logger.setLevel(_lvl if isinstance(_lvl, int) else logging.INFO)
+_logger.addHandler(logging.handlers.QueueHandler(_LOG_Q))
+_stdout = logging.StreamHandler(sys.stdout)
+_stdout.setFormatter(_Formatter())
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_Q, _stdout)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)   # drain before exit, incl. fatal()
+LOG_MQTT_SENT = _logger.isEnabledFor(logging.DEBUG)
+
 def log(level, msg):
-    sys.stdout.write(f"[{datetime.utcnow().isoformat()}] [{level}] {msg}\n")
-    sys.stdout.flush()
+    _logger.log(_level(level), msg, extra={"tag": level})
 
 def fatal(msg):
     log("FATAL", msg)
     sys.exit(1)
 
+# ---------------------------------------------------------------------
+# JSON (orjson when available, stdlib otherwise; dumps returns bytes)
+# ---------------------------------------------------------------------
+
+if orjson:
+    dumps, loads = orjson.dumps, orjson.loads
+else:
+    # Compact like orjson, so spliced envelope pieces match either backend
+    def dumps(obj): return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    loads = json.loads
+
+def payload_encoder(fmt):
+    """Encoder for outgoing MQTT payloads (mqtt_payload_format)."""
+    if fmt == "msgpack":
+        if not msgpack: fatal("mqtt_payload_format msgpack requires the msgpack package")
+        return functools.partial(msgpack.packb, use_bin_type=True)
+    return dumps
+
 # ---------------------------------------------------------------------
 # Shutdown handling
 # ---------------------------------------------------------------------
@@ -33,41 +100,188 @@ def shutdown(signum, frame):
 
 def load_options():
     try:
-        with open(OPTIONS_FILE, "r", encoding="utf-8") as f: return json.load(f)
+        with open(OPTIONS_FILE, "rb") as f: return loads(f.read())
     except Exception as e: fatal(f"options.json error: {e}")
 
+# ---------------------------------------------------------------------
+# TLS CA (tls_ca_url), cached in /data and revalidated with If-None-Match
+# ---------------------------------------------------------------------
+
+def ensure_ca(url):
+    """Returns True when a new CA was written to CA_FILE. A 304 or a failed
+    download leaves the cached copy (if any) in place."""
+    headers = {}
+    if os.path.exists(CA_FILE) and os.path.exists(CA_ETAG_FILE):
+        with open(CA_ETAG_FILE, "r", encoding="utf-8") as f: headers["If-None-Match"] = f.read().strip()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=15) as r:
+            pem, etag = r.read(), r.headers.get("ETag")
+        ssl.create_default_context().load_verify_locations(cadata=pem.decode("ascii"))   # reject non-PEM bodies
+        with open(CA_FILE + ".tmp", "wb") as f: f.write(pem)
+        os.replace(CA_FILE + ".tmp", CA_FILE)
+        if etag:
+            with open(CA_ETAG_FILE, "w", encoding="utf-8") as f: f.write(etag)
+        elif os.path.exists(CA_ETAG_FILE):
+            os.remove(CA_ETAG_FILE)
+        log("INFO", f"CA downloaded ({len(pem)} bytes)")
+        return True
+    except urllib.error.HTTPError as e:
+        if e.code == 304: return False
+        log("TLS_WARN", f"CA download failed: {e}")
+    except Exception as e:
+        log("TLS_WARN", f"CA download failed: {e}")
+    return False
+
+
+async def refresh_ca_loop(mqtt_ready, url, interval=CA_REFRESH_SECONDS):
+    """Picks up a rotated CA without a restart; used on the next reconnect."""
+    if not url: return
+    c = await mqtt_ready
+    loop = asyncio.get_running_loop()
+    while not shutdown_event.is_set():
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            if await loop.run_in_executor(None, ensure_ca, url):
+                c.ssl_ctx.load_verify_locations(CA_FILE)
+
 # ---------------------------------------------------------------------
 # MQTT
 # ---------------------------------------------------------------------
 
-_CONTROL_CHARS = re.compile(r"[\x00-\x1F\x7F]")
+# Control characters (0x00-0x1F, DEL) map to None: str.translate strips
+# them in C without a regex pass
+_CTRL_TABLE = dict.fromkeys([*range(0x20), 0x7F])
+
+def clean_str(value):
+    # Printable strings (the common case) contain no control characters
+    return (value if value.isprintable() else value.translate(_CTRL_TABLE)).strip()
+
+# Payload keys come from a small fixed vocabulary (entity_id, state,
+# attributes, ...), so their cleaned form is memoized.
+_clean_key = functools.lru_cache(maxsize=512)(clean_str)
+
 def deep_clean(value):
     if isinstance(value, str):
-        return _CONTROL_CHARS.sub("", value).strip()
+        return clean_str(value)
     if isinstance(value, list):
         return [deep_clean(v) for v in value]
     if isinstance(value, dict):
-        return {deep_clean(k): deep_clean(v) for k, v in value.items()}  # key + value
+        return {_clean_key(k): deep_clean(v) for k, v in value.items()}  # key + value
     return value
 
 
 
-def mqtt_setup(o):
+async def mqtt_client(o, ssl_ctx):
     c = mqtt.Client(protocol=mqtt.MQTTv311)
     if o.get("mqtt_username"): c.username_pw_set(o["mqtt_username"], o.get("mqtt_password"))
-    c.tls_set()
-    c.connect(o["mqtt_host"], int(o.get("mqtt_port", 8883)), 60)
+    c.tls_set_context(ssl_ctx)
+    # Wider than paho's default window of 20 so QoS>0 is not ack-bound
+    c.max_inflight_messages_set(int(o.get("mqtt_inflight", 100)))
+    c.max_queued_messages_set(10000)   # hard cap on paho's QoS>0 queue
+    # Blocking TCP + TLS handshake runs off the event loop
+    await asyncio.get_running_loop().run_in_executor(
+        None, c.connect, o["mqtt_host"], int(o.get("mqtt_port", 8883)), 60)
+    tune_socket(c)
     c.loop_start()
     log("INFO", "MQTT connected")
     return c
 
 
-def publish(c, topic, payload):
+def tune_socket(c):
+    # Publishes are already batched: send each batch at once (no Nagle) and
+    # leave room in the kernel buffer for a large one in a single write
+    try:
+        sock = c.socket()
+        if sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    except OSError as e:
+        log("MQTT_WARN", f"socket tuning failed: {e}")
+
+
+class MqttPool:
+    """Round-robin over N paho clients (N > 1 loses cross-batch order);
+    publish() waits while max_pending publishes are unconfirmed."""
+
+    def __init__(self, clients, ssl_ctx, max_pending):
+        self.clients = clients
+        self.ssl_ctx = ssl_ctx
+        self._next = itertools.cycle(clients).__next__
+        self._loop = asyncio.get_running_loop()
+        self._max_pending = max_pending
+        self._pending = dict.fromkeys(clients, 0)   # client -> unconfirmed publishes
+        self._total = 0
+        self._room = asyncio.Event()
+        self._room.set()
+        for c in clients:
+            c.on_publish = self._on_publish
+            c.on_connect = self._on_connect
+
+    # paho callbacks run on the network threads; hand off to the loop
+    def _on_publish(self, client, userdata, mid, *_):
+        self._loop.call_soon_threadsafe(self._confirmed, client)
+
+    def _on_connect(self, client, userdata, flags, rc, *_):
+        tune_socket(client)   # each reconnect opens a fresh socket
+        # A reconnect discards this client's unsent QoS 0 packets, whose
+        # on_publish never comes
+        self._loop.call_soon_threadsafe(self._reset, client)
+
+    def _confirmed(self, client):
+        if self._pending[client]:
+            self._pending[client] -= 1
+            self._total -= 1
+        if self._total < self._max_pending: self._room.set()
+
+    def _reset(self, client):
+        self._total -= self._pending[client]
+        self._pending[client] = 0
+        if self._total < self._max_pending: self._room.set()
+
+    async def publish(self, topic, payload, qos=0):
+        while self._total >= self._max_pending:
+            self._room.clear()
+            await self._room.wait()
+        c = self._next()
+        info = c.publish(topic, payload, qos=qos)
+        # Dropped messages (QoS 0 while offline, paho queue full) never confirm;
+        # QoS>0 offline messages stay queued in paho and confirm after reconnect
+        if info.rc == mqtt.MQTT_ERR_SUCCESS or (qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN):
+            self._pending[c] += 1
+            self._total += 1
+        return info
+
+
+def tls_context(ca_file=None):
+    # One context (and one parse of the trust store) shared by every client
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = True
+    ctx.verify_mode = ssl.CERT_REQUIRED
+    if ca_file and os.path.exists(ca_file):
+        ctx.load_verify_locations(ca_file)
+    return ctx
+
+
+async def mqtt_setup(o):
+    size = max(1, int(o.get("mqtt_pool_size", 1)))
+    if o.get("tls_ca_url"):
+        await asyncio.get_running_loop().run_in_executor(None, ensure_ca, o["tls_ca_url"])
+    ssl_ctx = tls_context(CA_FILE if o.get("tls_ca_url") else None)
+    try:
+        clients = await asyncio.gather(*(mqtt_client(o, ssl_ctx) for _ in range(size)))
+    except Exception as e:
+        fatal(f"MQTT connect error: {e}")
+    return MqttPool(list(clients), ssl_ctx, max(1, int(o.get("mqtt_max_pending", 1024))))
+
+
+async def publish(c, topic, data, qos=1):
+    # data comes pre-encoded (envelope_encoder / heartbeat) and is
+    # clean by construction: HA events are deep_clean()ed at ingest,
+    # gateway_id at startup
     try:
-        payload = deep_clean(payload)   # ← PAKOLLINEN
-        data = json.dumps(payload, ensure_ascii=False)
-        c.publish(topic, data, qos=1)
-        log("MQTT_SENT", f"{len(data)} bytes")
+        await c.publish(topic, data, qos=qos)
+        if LOG_MQTT_SENT: log("MQTT_SENT", f"{len(data)} bytes")
     except Exception as e:
         log("MQTT_ERROR", str(e))
 
@@ -76,7 +290,92 @@ def publish(c, topic, payload):
 # Home Assistant WebSocket listener
 # ---------------------------------------------------------------------
 
-async def ha_listener(c, topic, gateway_id):
+# HA serializes frames compactly, so these substrings are exact. A frame
+# that fails them can never be published and is dropped before decoding.
+_EVENT_TYPE = '"type":"event"'   # near the start of every event frame
+_STATE_CHANGED = '"state_changed"'
+_NULL_STATES = ('"new_state":null', '"old_state":null')
+_EMPTY = {}   # shared read-only default, never mutated
+
+_LAST = OrderedDict()   # entity_id -> (last published value, monotonic ts), LRU order
+_LAST_MAX = 8192
+
+def skip_frame(raw):
+    # result/pong/auth frames fail the first, bounded check
+    return (_EVENT_TYPE not in raw[:96] or _STATE_CHANGED not in raw
+            or _NULL_STATES[0] in raw or _NULL_STATES[1] in raw)
+
+# State strings known not to parse as float ("on", "unavailable", ...);
+# keyed by state, not entity_id, so an entity can recover.
+_NON_NUMERIC = set()
+_NON_NUMERIC_MAX = 4096
+
+def as_float(state):
+    """float(state), or None for a non-numeric state; repeats of a known
+    non-numeric state cost one set lookup instead of a raised ValueError."""
+    if isinstance(state, str) and state in _NON_NUMERIC:
+        return None
+    try:
+        return float(state)
+    except (TypeError, ValueError):
+        if isinstance(state, str):
+            if len(_NON_NUMERIC) >= _NON_NUMERIC_MAX:
+                _NON_NUMERIC.pop()   # arbitrary eviction keeps it bounded
+            _NON_NUMERIC.add(state)
+        return None
+
+def entity_filter(include, exclude):
+    """Predicate over entity_id built from include/exclude glob lists
+    (each compiled into one regex); None when neither list is set."""
+    inc = re.compile("|".join(map(fnmatch.translate, include))) if include else None
+    exc = re.compile("|".join(map(fnmatch.translate, exclude))) if exclude else None
+    if not inc and not exc:
+        return None
+
+    @functools.lru_cache(maxsize=4096)   # entity_ids repeat forever
+    def allowed(entity_id):
+        return bool((not inc or inc.match(entity_id)) and not (exc and exc.match(entity_id)))
+    return allowed
+
+# Forward the event text verbatim only if deep_clean() would be a no-op;
+# HA puts "id" either first or last in the frame.
+_EVENT_MEMBER = '"type":"event","event":{"event_type":'
+_EVENT_START = len('"type":"event","event":')
+_ID_KEY = ',"id":'
+_NEEDS_CLEAN = re.compile(r'\\|\x7f|"\s|\s"')
+
+def clean_event_text(raw):
+    """The frame's event object as UTF-8 bytes, or None if it needs cleaning."""
+    i = raw.find(_EVENT_MEMBER)
+    if i < 0:
+        return None
+    if raw.endswith("}}"):                 # id first: the event closes the frame
+        end = len(raw) - 1
+    else:                                  # id last: strip the trailing ,"id":N}
+        end = raw.rfind(_ID_KEY, i)
+        if end < 0 or raw[end - 1] != "}" or not raw[end + len(_ID_KEY):-1].isdigit():
+            return None
+    text = raw[i + _EVENT_START:end]
+    return None if _NEEDS_CLEAN.search(text) else text.encode()
+
+class EventQueue(asyncio.Queue):
+    """Bounded hand-off to the publisher; push() drops the oldest event when
+    full and counts it in dropped."""
+
+    dropped = 0
+
+    def push(self, item):
+        try:
+            self.put_nowait(item)
+        except asyncio.QueueFull:
+            try:
+                self.get_nowait()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+            self.put_nowait(item)
+
+async def ha_listener(events, allowed, dedup_ttl, dedup_epsilon):
     try:
         import websockets
     except Exception:
@@ -90,105 +389,225 @@ async def ha_listener(c, topic, gateway_id):
 
     while not shutdown_event.is_set():
         try:
-            async with websockets.connect(HA_WS_URL) as ws:
-                json.loads(await ws.recv())
-                await ws.send(json.dumps({"type": "auth", "access_token": token}))
-                json.loads(await ws.recv())
-                await ws.send(json.dumps({
+            # Local supervisor link: permessage-deflate would only cost CPU.
+            # 4 MiB frame cap leaves room for attribute-heavy entities.
+            async with websockets.connect(HA_WS_URL, compression=None, max_size=2**22) as ws:
+                loads(await ws.recv())
+                await ws.send(dumps({"type": "auth", "access_token": token}).decode())
+                loads(await ws.recv())
+                await ws.send(dumps({
                     "id": 1,
                     "type": "subscribe_events",
                     "event_type": "state_changed"
-                }))
-                backoff = 1
+                }).decode())
 
-                while not shutdown_event.is_set():
+                async for raw in ws:
+                    if shutdown_event.is_set():
+                        break
+                    if skip_frame(raw):
+                        continue
                     try:
-                        msg = json.loads(await ws.recv())
+                        msg = loads(raw)
                     except Exception as e:
                         log("WS_ERROR", str(e))
                         break
 
                     if msg.get("type") != "event":
                         continue
+                    backoff = 1   # only a delivered event proves the session works
 
-                    ev = msg.get("event", {})
-                    data = ev.get("data", {})
-
-                    ns = data.get("new_state")
-                    os_ = data.get("old_state")
+                    ev = msg.get("event") or _EMPTY
+                    data = ev.get("data") or _EMPTY
+                    entity_id = data.get("entity_id") or ""
+                    if allowed and not allowed(entity_id):
+                        continue
 
+                    ns, os_ = data.get("new_state"), data.get("old_state")
                     if not ns or not os_:
                         continue
 
                     # --- Validate numeric measurement ---
-                    try:
-                        new_val = float(ns.get("state"))
-                        old_val = float(os_.get("state"))
-                    except Exception:
+                    new_val = as_float(ns.get("state"))
+                    if new_val is None:
+                        continue
+                    old_val = as_float(os_.get("state"))
+                    if old_val is None:
                         continue
 
                     # --- Ignore non-changing or transient updates ---
                     if new_val == old_val:
                         continue
 
-                    publish(c, topic, {
-                        "schema_version": 1,
-                        "source": "homeassistant",
-                        "ts": int(datetime.utcnow().timestamp() * 1000),
-                        "gateway": {
-                            "type": "ha_addon",
-                            "gateway_id": gateway_id
-                        },
-                        "event": ev,
-                    })
-
-
+                    # --- Suppress values already published within dedup_ttl ---
+                    if dedup_ttl > 0:
+                        now = time.monotonic()
+                        prev = _LAST.get(entity_id)
+                        if prev:
+                            _LAST.move_to_end(entity_id)
+                            if abs(new_val - prev[0]) <= dedup_epsilon and now - prev[1] < dedup_ttl:
+                                continue
+                        _LAST[entity_id] = (new_val, now)
+                        if len(_LAST) > _LAST_MAX:
+                            _LAST.popitem(last=False)
+
+                    ev_json = clean_event_text(raw)
+                    if ev_json is None:
+                        ev = deep_clean(ev)   # ← PAKOLLINEN
+                    events.push((ev, ev_json))
 
         except Exception as e:
             log("WS_WARN", str(e))
 
         try:
-            await asyncio.wait_for(shutdown_event.wait(), timeout=backoff)
+            # Jitter keeps restarted add-ons from reconnecting in lockstep
+            await asyncio.wait_for(shutdown_event.wait(), timeout=backoff * (0.5 + random.random()))
         except asyncio.TimeoutError:
             backoff = min(backoff * 2, 30)
 
+    # Tells the publisher to flush and stop; put() waits for room rather
+    # than evicting a queued event the way push() would
+    await events.put(None)
+
+# ---------------------------------------------------------------------
+# Publisher
+# ---------------------------------------------------------------------
+
+def envelope_encoder(gateway_id, encode=dumps):
+    """Encodes the envelope around one (event, event_json) item or a batch;
+    for JSON only ts and the event texts are spliced into pre-encoded parts."""
+    gateway = {"type": "ha_addon", "gateway_id": gateway_id}   # invariant per run
+    if encode is not dumps:
+        def envelope(ts, items):
+            payload = {"schema_version": 1, "source": "homeassistant", "ts": ts, "gateway": gateway}
+            if len(items) == 1:
+                payload["event"] = items[0][0]
+            else:
+                payload["batch"] = [ev for ev, _ in items]
+            return encode(payload)
+        return envelope
+
+    head = dumps({"schema_version": 1, "source": "homeassistant", "ts": 0})[:-2]
+    gw = b"," + dumps({"gateway": gateway})[1:-1] + b","
+    one, many = gw + dumps("event") + b":", gw + dumps("batch") + b":["
+
+    def event_json(item):
+        return item[1] or dumps(item[0])
+
+    def envelope(ts, items):
+        if len(items) == 1:
+            return b"".join((head, b"%d" % ts, one, event_json(items[0]), b"}"))
+        return b"".join((head, b"%d" % ts, many, b",".join(map(event_json, items)), b"]}"))
+    return envelope
+
+async def publisher(mqtt_ready, events, topic, gateway_id, batch_ms, batch_max, encode, qos):
+    """Publishes up to batch_max events collected within batch_ms as one
+    message; a lone event keeps the single-event envelope."""
+    c = await mqtt_ready
+    loop = asyncio.get_running_loop()
+    envelope = envelope_encoder(gateway_id, encode)
+    window = batch_ms / 1000
+
+    stop = False
+    while not stop:
+        batch = [await events.get()]
+        deadline = loop.time() + window
+        while len(batch) < batch_max and batch[-1] is not None:
+            try:
+                batch.append(events.get_nowait())
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(events.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+        if batch[-1] is None:
+            stop = True
+            batch.pop()
+        if not batch:
+            continue
 
+        try:
+            data = envelope(time.time_ns() // 1_000_000, batch)
+        except Exception as e:
+            log("MQTT_ERROR", f"encode failed: {e}")
+            continue
+        await publish(c, topic, data, qos)
 
 # ---------------------------------------------------------------------
 # Heartbeat
 # ---------------------------------------------------------------------
 
-async def heartbeat(c, topic, gateway_id, interval):
-    counter = 0
+async def heartbeat(mqtt_ready, events, topic, gateway_id, interval, encode):
+    c = await mqtt_ready
+    loop = asyncio.get_running_loop()
+    counter = reported = 0
+    # Fixed schedule on the loop's monotonic clock: one wakeup per beat, no
+    # drift from publish time, no effect from wall-clock jumps
+    next_ts = loop.time() + interval
     while not shutdown_event.is_set():
         try:
-            await asyncio.wait_for(shutdown_event.wait(), timeout=interval)
+            await asyncio.wait_for(shutdown_event.wait(), timeout=max(0, next_ts - loop.time()))
         except asyncio.TimeoutError:
             counter += 1
-            publish(c, topic, {
+            dropped = events.dropped
+            if dropped != reported:
+                log("QUEUE_WARN", f"{dropped - reported} events dropped since last heartbeat ({dropped} total)")
+                reported = dropped
+            await publish(c, topic, encode({
                 "schema_version": 1,
                 "source": "ha_addon",
-                "ts": int(datetime.utcnow().timestamp() * 1000),
-                "heartbeat": {"gateway_id": gateway_id, "counter": counter},
-            })
+                "ts": time.time_ns() // 1_000_000,
+                "heartbeat": {"gateway_id": gateway_id, "counter": counter, "dropped": dropped},
+            }))
+            # A stalled publish skips missed beats instead of firing them late
+            next_ts += interval
+            now = loop.time()
+            if next_ts <= now:
+                next_ts += ((now - next_ts) // interval + 1) * interval
 
 # ---------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------
 
+async def run(o):
+    # Loop-level handlers wake the loop immediately; a plain signal.signal
+    # handler only runs once the loop next returns to Python code
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, shutdown, sig, None)
+
+    encode = payload_encoder(o.get("mqtt_payload_format", "json"))
+    gateway_id = clean_str(str(o.get("gateway_id", "unknown")))
+    events = EventQueue(maxsize=max(1, int(o.get("queue_size", 1024))))
+    # MQTT connects in the background while the listener authenticates with HA
+    mqtt_ready = asyncio.ensure_future(mqtt_setup(o))
+    await asyncio.gather(
+        ha_listener(events,
+                    entity_filter(o.get("include_patterns"), o.get("exclude_patterns")),
+                    float(o.get("dedup_ttl_seconds", 60)), float(o.get("dedup_epsilon", 0))),
+        publisher(mqtt_ready, events, o["mqtt_topic"], gateway_id,
+                  int(o.get("batch_ms", 50)), int(o.get("batch_max", 100)), encode,
+                  int(o.get("mqtt_qos", 0))),
+        heartbeat(mqtt_ready, events, o["mqtt_topic"], gateway_id,
+                  int(o.get("heartbeat_interval_seconds", 15)), encode),
+        refresh_ca_loop(mqtt_ready, o.get("tls_ca_url"))
+    )
+
 def main():
     log("INFO", "OPENIOTAI ADD-ON START")
     signal.signal(signal.SIGTERM, shutdown)
     signal.signal(signal.SIGINT, shutdown)
 
     o = load_options()
-    c = mqtt_setup(o)
-
-    asyncio.get_event_loop().run_until_complete(asyncio.gather(
-        ha_listener(c, o["mqtt_topic"], o.get("gateway_id", "unknown")),
-        heartbeat(c, o["mqtt_topic"], o.get("gateway_id", "unknown"),
-                  int(o.get("heartbeat_interval_seconds", 15)))
-    ))
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(run(o))
 
 if __name__ == "__main__":
     main()